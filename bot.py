@@ -1,20 +1,40 @@
 import os
+import re
+import sys
+import atexit
+import signal
+import html
 import json
-import uuid
+import bisect
+import secrets
 import time
-from datetime import datetime, timedelta
-from typing import Dict, Any, List, Optional, Tuple
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, Set, Tuple
+from zoneinfo import ZoneInfo
 
-import pytz
 import telebot
+from telebot.custom_filters import SimpleCustomFilter
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor
+from cachetools import TTLCache
 
 try:
     from openpyxl import load_workbook
 except Exception as e:
     raise RuntimeError("Не установлен openpyxl. Добавь в requirements.txt строку: openpyxl") from e
 
+try:
+    import orjson
+except ImportError:
+    # без orjson работаем на стандартном json — просто медленнее
+    orjson = None
+
 
 # ================== ВЕРСИЯ ==================
 BOT_VERSION = "topic-locked-storage-no-exit-no-reload-stop-admin-2026-01-08-07"
@@ -23,27 +43,47 @@ BOT_VERSION = "topic-locked-storage-no-exit-no-reload-stop-admin-2026-01-08-07"
 # ================== НАСТРОЙКИ ==================
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "").strip()
 DATA_FILE = "reminders.json"
+# журнал добавлений: новые напоминания дописываются сюда строкой, reminders.json целиком не переписываем
+JOURNAL_FILE = "reminders.jsonl"
 
 TZ_NAME = os.environ.get("BOT_TZ", "Europe/Moscow")
-TZ = pytz.timezone(TZ_NAME)
+TZ = ZoneInfo(TZ_NAME)
 
 DATE_PICK_DAYS = int(os.environ.get("DATE_PICK_DAYS", "21"))
 
 AUTO_DELETE_AFTER_HOURS = int(os.environ.get("AUTO_DELETE_AFTER_HOURS", "24"))
-CLEANUP_INTERVAL_MINUTES = int(os.environ.get("CLEANUP_INTERVAL_MINUTES", "1"))
 
 STORAGE_FILE_ENV = os.environ.get("STORAGE_FILE", "").strip()
 
+# брошенные на полпути сценарии (добавление/поиск) забываем через столько минут
+STATE_TTL_MINUTES = int(os.environ.get("STATE_TTL_MINUTES", "30"))
+
+# сколько апдейтов обрабатываем параллельно: хендлеры в основном ждут сеть (send/edit), а не CPU.
+# Общее состояние хендлеров синхронизировано: states — под _STATES_LOCK, стор напоминаний — под
+# _STORE_LOCK, база сроков подменяется целым снимком STORAGE. Новое общее состояние — так же.
+BOT_WORKER_THREADS = int(os.environ.get("BOT_WORKER_THREADS", "8"))
+# потоки планировщика: сколько напоминаний может отправляться одновременно
+SCHEDULER_WORKERS = int(os.environ.get("SCHEDULER_WORKERS", "10"))
+
 ADMIN_USERNAME = "AnatoliiOsin"   # только он видит админ-кнопки
 
 if not BOT_TOKEN:
     raise RuntimeError("Не задан BOT_TOKEN. Добавь переменную окружения BOT_TOKEN в панели хостинга (Bothost).")
 
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
-scheduler = BackgroundScheduler(timezone=TZ)
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", num_threads=BOT_WORKER_THREADS)
+# coalesce: пропущенные запуски одной задачи (например, после паузы) схлопываются в один
+scheduler = BackgroundScheduler(
+    timezone=TZ,
+    executors={"default": ThreadPoolExecutor(SCHEDULER_WORKERS)},
+    job_defaults={"coalesce": True, "max_instances": 1}
+)
 scheduler.start()
 
-states: Dict[int, Dict[str, Any]] = {}
+# Ограниченный кэш с TTL вместо обычного dict: незавершённые сценарии не копятся в памяти вечно.
+states: TTLCache = TTLCache(maxsize=10_000, ttl=STATE_TTL_MINUTES * 60)
+# TTLCache не потокобезопасен (даже запись чистит просроченное), а хендлеры идут из пула TeleBot —
+# любое обращение к states только под этим локом, через хелперы из STATE HELPERS
+_STATES_LOCK = threading.Lock()
 
 
 # ================== HELPERS (ADMIN / TOPICS) ==================
@@ -91,11 +131,14 @@ def load_data() -> Dict[str, Any]:
     if not os.path.exists(DATA_FILE):
         return {"reminders": [], "chat_settings": {}}
 
-    with open(DATA_FILE, "r", encoding="utf-8") as f:
-        try:
-            data = json.load(f)
-        except json.JSONDecodeError:
-            return {"reminders": [], "chat_settings": {}}
+    # файл читаем одним read() в байтах — orjson разбирает bytes напрямую, без декодирования в str
+    with open(DATA_FILE, "rb") as f:
+        raw = f.read()
+    try:
+        data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    except ValueError:
+        # orjson.JSONDecodeError и json.JSONDecodeError — наследники ValueError
+        return {"reminders": [], "chat_settings": {}}
 
     if "reminders" not in data or not isinstance(data["reminders"], list):
         data["reminders"] = []
@@ -109,90 +152,232 @@ def save_data(data: Dict[str, Any]) -> None:
         data["reminders"] = []
     if "chat_settings" not in data:
         data["chat_settings"] = {}
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    # поля с "_" — кэши в памяти (например, _render), в файл их не пишем
+    data = {
+        **data,
+        "reminders": [{k: v for k, v in r.items() if not k.startswith("_")} for r in data["reminders"]],
+    }
+    # файл читает только бот — пишем компактно, без отступов: меньше байт на запись и на разбор
+    if orjson is not None:
+        payload = orjson.dumps(data)
+    else:
+        payload = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    # пишем во временный файл и подменяем одним rename — падение посреди записи не портит reminders.json;
+    # fsync до rename, чтобы после рестарта контейнера не получить пустой файл под новым именем
+    tmp = DATA_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, DATA_FILE)
+
+
+# Добавление напоминания — одна строка в конец журнала вместо перезаписи всего reminders.json.
+# При полной записи стора журнал обнуляется, при старте — дочитывается поверх основного файла.
+def _journal_append(rem: Dict[str, Any]) -> None:
+    rec = {k: v for k, v in rem.items() if not k.startswith("_")}
+    if orjson is not None:
+        line = orjson.dumps(rec) + b"\n"
+    else:
+        line = (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+    with _STORE_LOCK:
+        with open(JOURNAL_FILE, "ab") as f:
+            f.write(line)
+
+
+def _load_journal() -> List[Dict[str, Any]]:
+    if not os.path.exists(JOURNAL_FILE):
+        return []
+    out: List[Dict[str, Any]] = []
+    with open(JOURNAL_FILE, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                out.append(orjson.loads(line) if orjson is not None else json.loads(line))
+            except ValueError:
+                # недописанная строка (падение посреди записи) — пропускаем
+                continue
+    return out
+
+
+# Файл читаем один раз при старте (_bootstrap), дальше все чтения/изменения идут через _STORE в памяти,
+# а на диск пишем только при изменениях.
+_STORE: Dict[str, Any] = {"reminders": [], "chat_settings": {}}
+
+# Стор трогают потоки telebot (хендлеры) и потоки планировщика (автоудаление, запись на диск).
+# Все чтения/изменения _STORE, индексов и журнала — под этим локом; RLock, т.к. функции вызывают друг друга.
+_STORE_LOCK = threading.RLock()
+
+# Индекс chat_id -> напоминания этого чата (те же dict-объекты, что в _BY_ID).
+# Каждый список держим отсортированным по времени события.
+_BY_CHAT: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+# Индекс id -> напоминание. Это основной список: _STORE["reminders"] собирается из него при записи на диск.
+_BY_ID: Dict[str, Dict[str, Any]] = {}
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _to_ns(dt: datetime) -> int:
+    # целые наносекунды UTC: сравнение и сортировка без разбора строк и без учёта смещений
+    return (dt - _EPOCH) // timedelta(microseconds=1) * 1000
+
+
+def _event_sort_key(r: Dict[str, Any]) -> int:
+    return r["_event_ns"]
+
+
+STORE_FLUSH_DELAY_SECONDS = 1
+
+_dirty: bool = False
+# глубина вложенных store_txn(): пока > 0, запись на диск не планируем
+_txn_depth: int = 0
+
+
+def _flush() -> None:
+    with _STORE_LOCK:
+        _STORE["reminders"] = list(_BY_ID.values())
+        save_data(_STORE)
+        # всё из журнала теперь есть в reminders.json
+        if os.path.exists(JOURNAL_FILE):
+            os.remove(JOURNAL_FILE)
+
+
+def _flush_if_dirty() -> None:
+    global _dirty
+    with _STORE_LOCK:
+        if not _dirty:
+            return
+        _dirty = False
+        _flush()
+
+
+def _mark_dirty() -> None:
+    """
+    Отложенная запись: все изменения за STORE_FLUSH_DELAY_SECONDS уходят на диск одной записью.
+    """
+    global _dirty
+    if _dirty:
+        # запись уже запланирована (или будет при выходе из store_txn)
+        return
+    _dirty = True
+    if _txn_depth:
+        return
+    _schedule_flush()
+
+
+def _schedule_flush() -> None:
+    scheduler.add_job(
+        _flush_if_dirty,
+        trigger="date",
+        run_date=now_tz() + timedelta(seconds=STORE_FLUSH_DELAY_SECONDS),
+        id="flush_store",
+        replace_existing=True,
+        # запись нельзя терять из-за опоздания (все потоки заняты рассылкой): _dirty останется True,
+        # и _mark_dirty больше никогда не запланирует flush — пусть выполнится, даже если поздно
+        misfire_grace_time=None
+    )
+
+
+@contextmanager
+def store_txn():
+    """
+    Группа изменений стора под одним локом: запись на диск планируется один раз, после выхода из блока.
+    """
+    global _txn_depth
+    with _STORE_LOCK:
+        _txn_depth += 1
+        try:
+            yield _STORE
+        finally:
+            _txn_depth -= 1
+            if not _txn_depth and _dirty:
+                _schedule_flush()
 
 
 def now_tz() -> datetime:
     return datetime.now(TZ)
 
 
-def dt_from_iso(iso_str: str) -> Optional[datetime]:
+# Одни и те же строки event_dt разбираются постоянно (список, очистка, планировщик).
+# datetime неизменяемый, TZ один на процесс — результат разбора можно кэшировать.
+@lru_cache(maxsize=4096)
+def _parse_iso_cached(iso_str: str) -> Optional[datetime]:
     try:
         dt = datetime.fromisoformat(iso_str)
         if dt.tzinfo is None:
-            dt = TZ.localize(dt)
-        else:
-            dt = dt.astimezone(TZ)
+            dt = dt.replace(tzinfo=TZ)
+        elif dt.tzinfo is not TZ:
+            # сохранённые строки почти всегда уже в нашем смещении — тогда хватает replace без пересчёта
+            local = dt.replace(tzinfo=TZ)
+            dt = local if local.utcoffset() == dt.utcoffset() else dt.astimezone(TZ)
         return dt
     except Exception:
         return None
 
 
+def dt_from_iso(iso_str: str) -> Optional[datetime]:
+    if not isinstance(iso_str, str):
+        return None
+    return _parse_iso_cached(iso_str)
+
+
 def dt_to_iso(dt: datetime) -> str:
     if dt.tzinfo is None:
-        dt = TZ.localize(dt)
-    else:
+        dt = dt.replace(tzinfo=TZ)
+    elif dt.tzinfo is not TZ and dt.utcoffset() != TZ.utcoffset(dt):
+        # при совпадающем смещении isoformat() и так даст ту же строку
         dt = dt.astimezone(TZ)
     return dt.isoformat()
 
 
-def add_reminder_to_store(rem: Dict[str, Any]) -> None:
-    data = load_data()
-    data["reminders"].append(rem)
-    save_data(data)
+def _prepare_reminder(r: Dict[str, Any], dt: datetime) -> None:
+    # готовая строка для списка и время в ns — чтобы не разбирать ISO на каждый показ/очистку
+    r["_render"] = f"<b>{html.escape(r['title'])}</b> — {dt.strftime('%d.%m.%Y %H:%M')}"
+    r["_event_ns"] = _to_ns(dt)
 
 
-def get_chat_reminders(chat_id: int) -> List[Dict[str, Any]]:
-    data = load_data()
-    items = [r for r in data.get("reminders", []) if int(r.get("chat_id", 0)) == int(chat_id)]
-
-    changed = False
-    for r in items:
-        dt = dt_from_iso(r.get("event_dt", ""))
-        if dt:
-            new_iso = dt_to_iso(dt)
-            if r.get("event_dt") != new_iso:
-                r["event_dt"] = new_iso
-                changed = True
-
-    items.sort(key=lambda r: r.get("event_dt", ""))
+def add_reminder_to_store(rem: Dict[str, Any], event_dt: Optional[datetime] = None) -> None:
+    with _STORE_LOCK:
+        # id из Telegram уже int; проверка только в отладке (python -O её убирает)
+        assert isinstance(rem["chat_id"], int)
+        _prepare_reminder(rem, event_dt or dt_from_iso(rem["event_dt"]))
+        _BY_ID[rem["id"]] = rem
+        bisect.insort(_BY_CHAT[rem["chat_id"]], rem, key=_event_sort_key)
+        _journal_append(rem)
 
-    if changed:
-        all_data = load_data()
-        by_id = {r.get("id"): r for r in items if r.get("id")}
-        for i, r in enumerate(all_data.get("reminders", [])):
-            rid = r.get("id")
-            if rid in by_id:
-                all_data["reminders"][i] = by_id[rid]
-        save_data(all_data)
 
-    return items
+def get_chat_reminders(chat_id: int) -> List[Dict[str, Any]]:
+    with _STORE_LOCK:
+        # копия, чтобы вызывающий код не мог случайно испортить индекс
+        return list(_BY_CHAT.get(chat_id, []))
 
 
 def get_allowed_thread_id(chat_id: int) -> Optional[int]:
-    data = load_data()
-    st = (data.get("chat_settings") or {}).get(str(chat_id), {})
-    tid = st.get("allowed_thread_id")
-    try:
-        return int(tid) if tid is not None else None
-    except Exception:
-        return None
+    with _STORE_LOCK:
+        st = _STORE["chat_settings"].get(str(chat_id), {})
+        tid = st.get("allowed_thread_id")
+        try:
+            return int(tid) if tid is not None else None
+        except Exception:
+            return None
 
 
 def set_allowed_thread_id(chat_id: int, thread_id: int) -> None:
-    data = load_data()
-    cs = data.setdefault("chat_settings", {})
-    cs.setdefault(str(chat_id), {})["allowed_thread_id"] = int(thread_id)
-    save_data(data)
+    with _STORE_LOCK:
+        cs = _STORE["chat_settings"]
+        cs.setdefault(str(chat_id), {})["allowed_thread_id"] = int(thread_id)
+        _mark_dirty()
 
 
 def clear_allowed_thread_id(chat_id: int) -> None:
-    data = load_data()
-    cs = data.setdefault("chat_settings", {})
-    if str(chat_id) in cs:
-        cs[str(chat_id)].pop("allowed_thread_id", None)
-    save_data(data)
+    with _STORE_LOCK:
+        cs = _STORE["chat_settings"]
+        if str(chat_id) in cs:
+            cs[str(chat_id)].pop("allowed_thread_id", None)
+        _mark_dirty()
 
 
 def in_allowed_topic_for_message(message) -> bool:
@@ -267,7 +452,8 @@ def send_locked(chat_id: int, text: str, reply_markup=None, disable_web_page_pre
 
 
 # ================== INLINE МЕНЮ ==================
-def kb_main_inline(user=None) -> InlineKeyboardMarkup:
+# Статичные клавиатуры собираем один раз при импорте и переиспользуем (telebot их не меняет).
+def _build_main_inline(admin: bool) -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup()
     kb.row(InlineKeyboardButton("📌 Напоминания", callback_data="nav_reminders"))
     kb.row(InlineKeyboardButton("📚 Полезная информация", callback_data="nav_useful"))
@@ -275,13 +461,23 @@ def kb_main_inline(user=None) -> InlineKeyboardMarkup:
     kb.row(InlineKeyboardButton("ℹ️ О боте", callback_data="nav_about"))
 
     # Админ-блок (только AnatoliiOsin)
-    if user is not None and is_admin_user(user):
+    if admin:
         kb.row(InlineKeyboardButton("📌 Закрепить эту тему", callback_data="admin_pin_topic"))
         kb.row(InlineKeyboardButton("🛑 Остановить бота", callback_data="admin_stop_bot"))
     return kb
 
 
-def kb_reminders_inline(user=None) -> InlineKeyboardMarkup:
+KB_MAIN = _build_main_inline(admin=False)
+KB_MAIN_ADMIN = _build_main_inline(admin=True)
+
+
+def kb_main_inline(user=None) -> InlineKeyboardMarkup:
+    if user is not None and is_admin_user(user):
+        return KB_MAIN_ADMIN
+    return KB_MAIN
+
+
+def _build_reminders_inline() -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup()
     kb.row(InlineKeyboardButton("➕ Добавить напоминание", callback_data="rem_add"))
     kb.row(InlineKeyboardButton("📋 Все напоминания", callback_data="rem_list"))
@@ -289,13 +485,19 @@ def kb_reminders_inline(user=None) -> InlineKeyboardMarkup:
     return kb
 
 
-def kb_cancel_inline() -> InlineKeyboardMarkup:
+KB_REMINDERS = _build_reminders_inline()
+
+
+def _build_cancel_inline() -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup()
     kb.row(InlineKeyboardButton("❌ Отмена", callback_data="cancel"))
     kb.row(InlineKeyboardButton("⬅️ Назад в меню", callback_data="nav_main"))
     return kb
 
 
+KB_CANCEL = _build_cancel_inline()
+
+
 # ================== ПОЛЕЗНАЯ ИНФОРМАЦИЯ (INLINE) ==================
 USEFUL_LINKS = {
     "rm_schedule": "https://docs.google.com/spreadsheets/d/1ZXCllmYkqmP6y9HRnYm0_2D2f63haeU-vI2gylnL6Pg/edit?usp=drive_link",
@@ -366,7 +568,7 @@ https://t.me/+l2rMTNe2I_VkMjNi
 """
 
 
-def kb_useful_inline() -> InlineKeyboardMarkup:
+def _build_useful_inline() -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup()
     kb.row(InlineKeyboardButton("🗓 Расписание РМ", url=USEFUL_LINKS["rm_schedule"]))
     kb.row(InlineKeyboardButton("🌴 График отпусков", url=USEFUL_LINKS["vacations"]))
@@ -380,7 +582,7 @@ def kb_useful_inline() -> InlineKeyboardMarkup:
     return kb
 
 
-def kb_protocol_inline() -> InlineKeyboardMarkup:
+def _build_protocol_inline() -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup()
     kb.row(InlineKeyboardButton("👔 РМ", url=USEFUL_LINKS["protocol_rm"]))
     kb.row(InlineKeyboardButton("🧑‍💼 Директора", url=USEFUL_LINKS["protocol_directors"]))
@@ -388,16 +590,31 @@ def kb_protocol_inline() -> InlineKeyboardMarkup:
     return kb
 
 
+KB_USEFUL = _build_useful_inline()
+KB_PROTOCOL = _build_protocol_inline()
+
+# «Ссылки на группы» — самый тяжёлый ответ: длинный текст + клавиатура. telebot принимает
+# reply_markup уже готовой JSON-строкой, так что сериализуем её один раз, а не на каждое нажатие.
+GROUPS_PAYLOAD = {
+    "text": GROUPS_TEXT,
+    "reply_markup": KB_USEFUL.to_json(),
+    "disable_web_page_preview": True,
+}
+
+
 # ================== INLINE ПИКЕРЫ ДАТЫ/ВРЕМЕНИ ==================
-def build_date_picker() -> InlineKeyboardMarkup:
-    kb = InlineKeyboardMarkup()
-    today = now_tz().date()
+_DOW = ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")
+
+# Клавиатура дат меняется только раз в сутки — держим последнюю собранную вместе с её датой
+_DATE_PICKER_CACHE: Tuple[Optional[date], Optional[InlineKeyboardMarkup]] = (None, None)
 
+
+def _build_date_picker(today: date) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardMarkup()
     buttons = []
     for i in range(DATE_PICK_DAYS):
         d = today + timedelta(days=i)
-        dow = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"][d.weekday()]
-        text = d.strftime("%d.%m") + f" ({dow})"
+        text = d.strftime("%d.%m") + f" ({_DOW[d.weekday()]})"
         buttons.append(InlineKeyboardButton(text, callback_data=f"date|{d.isoformat()}"))
 
     for i in range(0, len(buttons), 2):
@@ -408,7 +625,22 @@ def build_date_picker() -> InlineKeyboardMarkup:
     return kb
 
 
-def build_time_picker() -> InlineKeyboardMarkup:
+def _refresh_date_picker() -> None:
+    global _DATE_PICKER_CACHE
+    today = now_tz().date()
+    _DATE_PICKER_CACHE = (today, _build_date_picker(today))
+
+
+def build_date_picker() -> InlineKeyboardMarkup:
+    cached_day, cached_kb = _DATE_PICKER_CACHE
+    if cached_day != now_tz().date() or cached_kb is None:
+        # страховка на случай, если полуночная задача ещё не успела отработать
+        _refresh_date_picker()
+        cached_day, cached_kb = _DATE_PICKER_CACHE
+    return cached_kb
+
+
+def _build_time_picker() -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup()
     common = ["09:00", "12:00", "15:00", "18:00", "21:00"]
     for i in range(0, len(common), 2):
@@ -422,14 +654,40 @@ def build_time_picker() -> InlineKeyboardMarkup:
     return kb
 
 
+# время не зависит от даты — клавиатура полностью статичная
+TIME_PICKER = _build_time_picker()
+
+
+# Ручной ввод проверяем заранее скомпилированными регулярками: strptime на каждый вызов
+# идёт через модуль _strptime и заметно медленнее. Форматы те же, что принимал strptime.
+_RE_TIME = re.compile(r"(\d{1,2}):(\d{1,2})")
+_RE_DATE_DMY = re.compile(r"(\d{1,2})\.(\d{1,2})\.(\d{4})")
+_RE_DATE_YMD = re.compile(r"(\d{4})-(\d{1,2})-(\d{1,2})")
+
+
 def validate_time_hhmm(s: str) -> bool:
+    m = _RE_TIME.fullmatch(s)
+    return bool(m) and int(m.group(1)) < 24 and int(m.group(2)) < 60
+
+
+def parse_date_input(raw: str) -> Optional[date]:
+    # 31.12.2026 или 2026-12-31
+    m = _RE_DATE_DMY.fullmatch(raw)
+    if m:
+        d, mo, y = m.groups()
+    else:
+        m = _RE_DATE_YMD.fullmatch(raw)
+        if not m:
+            return None
+        y, mo, d = m.groups()
     try:
-        datetime.strptime(s, "%H:%M")
-        return True
+        return date(int(y), int(mo), int(d))
     except ValueError:
-        return False
+        return None
 
 
+# вызывается из задач-напоминаний с одними и теми же ISO-строками; результат — неизменяемая str
+@lru_cache(maxsize=4096)
 def format_event_dt(iso_str: str) -> str:
     dt = dt_from_iso(iso_str)
     if not dt:
@@ -438,106 +696,221 @@ def format_event_dt(iso_str: str) -> str:
 
 
 # ================== ПЛАНИРОВЩИК НАПОМИНАНИЙ ==================
-def schedule_reminder_jobs(reminder: Dict[str, Any]) -> None:
-    rem_id = reminder["id"]
-    chat_id = int(reminder["chat_id"])
-    title = reminder["title"]
+REMINDER_OFFSETS = (
+    ("24h", timedelta(hours=24), "за 24 часа"),
+    ("1h", timedelta(hours=1), "за 1 час"),
+)
+# все задачи одного напоминания: уведомления + автоудаление
+REMINDER_JOB_KINDS = tuple(kind for kind, _, _ in REMINDER_OFFSETS) + ("gc",)
 
-    event_dt = dt_from_iso(reminder["event_dt"])
-    if not event_dt:
-        return
+
+def _send_reminder(chat_id: int, title_html: str, event_iso: str, label: str, thread_id: Optional[int]) -> None:
+    send_locked(
+        chat_id,
+        f"⏰ Напоминание ({label})\n"
+        f"<b>{title_html}</b>\n"
+        f"📅 Событие: <b>{format_event_dt(event_iso)}</b>",
+        fallback_thread_id=thread_id
+    )
+
+
+def schedule_reminder_jobs(reminder: Dict[str, Any], event_dt: Optional[datetime] = None) -> None:
+    rem_id = reminder["id"]
+    chat_id = reminder["chat_id"]
+    # название пользовательское, а сообщения идут с parse_mode=HTML: экранируем один раз здесь,
+    # как и в _render списка, — иначе «<» или «&» в названии и Telegram отклонит напоминание
+    title_html = html.escape(reminder["title"])
+
+    # вызывающий обычно уже держит разобранный datetime — тогда ISO не разбираем повторно
+    if event_dt is None:
+        event_dt = dt_from_iso(reminder["event_dt"])
+        if not event_dt:
+            return
 
     thread_id = reminder.get("thread_id")
-    try:
-        thread_id = int(thread_id) if thread_id is not None else None
-    except Exception:
-        thread_id = None
 
-    for kind, delta, label in [
-        ("24h", timedelta(hours=24), "за 24 часа"),
-        ("1h", timedelta(hours=1), "за 1 час"),
-    ]:
+    now = now_tz()
+    for kind, delta, label in REMINDER_OFFSETS:
         run_at = event_dt - delta
         job_id = f"{rem_id}_{kind}"
 
-        if run_at <= now_tz():
-            try:
+        if run_at <= now:
+            # старая задача бывает только при перепланировании — проверяем, а не ловим исключение
+            if scheduler.get_job(job_id) is not None:
                 scheduler.remove_job(job_id)
-            except Exception:
-                pass
             continue
 
-        def _send(chat_id=chat_id, title=title, event_dt=event_dt, label=label, thread_id=thread_id):
-            send_locked(
-                chat_id,
-                f"⏰ Напоминание ({label})\n"
-                f"<b>{title}</b>\n"
-                f"📅 Событие: <b>{event_dt.strftime('%d.%m.%Y %H:%M')}</b>",
-                fallback_thread_id=thread_id
-            )
-
+        # функция модульная, в args только простые значения (ISO-строка, а не datetime) —
+        # задачу можно сериализовать, если хранилище задач станет постоянным
         scheduler.add_job(
-            _send,
+            _send_reminder,
             trigger="date",
             run_date=run_at,
+            args=(chat_id, title_html, reminder["event_dt"], label, thread_id),
             id=job_id,
             replace_existing=True,
             misfire_grace_time=60 * 10
         )
 
+    # автоудаление — своя разовая задача на каждое напоминание, без периодического обхода всех записей
+    gc_at = event_dt + timedelta(hours=AUTO_DELETE_AFTER_HOURS)
+    if gc_at > now:
+        scheduler.add_job(
+            _delete_reminder,
+            trigger="date",
+            run_date=gc_at,
+            args=(rem_id,),
+            id=f"{rem_id}_gc",
+            replace_existing=True,
+            misfire_grace_time=None
+        )
+
 
-def reschedule_all_from_store() -> None:
-    data = load_data()
-    for r in data.get("reminders", []):
-        dt = dt_from_iso(r.get("event_dt", ""))
-        if dt:
-            r["event_dt"] = dt_to_iso(dt)
-        schedule_reminder_jobs(r)
-    save_data(data)
+def _delete_reminder(rem_id: str) -> None:
+    with _STORE_LOCK:
+        r = _BY_ID.pop(rem_id, None)
+        if r is None:
+            return
+        chat_id = r["chat_id"]
+        items = _BY_CHAT.get(chat_id)
+        if items:
+            i = bisect.bisect_left(items, r["_event_ns"], key=_event_sort_key)
+            while i < len(items) and items[i] is not r:
+                i += 1
+            if i < len(items):
+                del items[i]
+            if not items:
+                del _BY_CHAT[chat_id]
+        _mark_dirty()
+
+
+def _remove_reminder_jobs(rem_ids: List[str]) -> None:
+    # снимаем задачи пачкой, пока планировщик на паузе — он не пересчитывает расписание на каждое удаление
+    scheduler.pause()
+    try:
+        # на паузе задачи не срабатывают и не удаляются сами — снимок id актуален до resume
+        existing = {job.id for job in scheduler.get_jobs()}
+        for rid in rem_ids:
+            for kind in REMINDER_JOB_KINDS:
+                job_id = f"{rid}_{kind}"
+                if job_id in existing:
+                    scheduler.remove_job(job_id)
+    finally:
+        scheduler.resume()
 
 
 def cleanup_expired() -> None:
-    data = load_data()
-    reminders = data.get("reminders", [])
-    if not reminders:
-        return
+    """
+    Разовая чистка при старте: то, что просрочилось, пока бот был выключен.
+    Дальше каждое напоминание удаляет своя задача {id}_gc.
+    """
+    with _STORE_LOCK:
+        if not _BY_ID:
+            return
 
-    cutoff = now_tz() - timedelta(hours=AUTO_DELETE_AFTER_HOURS)
-    keep: List[Dict[str, Any]] = []
-    removed_ids: List[str] = []
+        # сравниваем заранее посчитанные _event_ns — целые числа, без разбора каждой записи
+        cutoff_ns = _to_ns(now_tz() - timedelta(hours=AUTO_DELETE_AFTER_HOURS))
+        removed_ids: List[str] = []
 
-    for r in reminders:
-        dt = dt_from_iso(r.get("event_dt", ""))
-        if not dt:
-            removed_ids.append(r.get("id", ""))
-            continue
+        # списки чатов отсортированы по времени — просроченные лежат в начале, режем их на месте
+        for chat_id in list(_BY_CHAT):
+            items = _BY_CHAT[chat_id]
+            n = bisect.bisect_left(items, cutoff_ns, key=_event_sort_key)
+            if not n:
+                continue
+            for r in items[:n]:
+                removed_ids.append(r["id"])
+                _BY_ID.pop(r["id"], None)
+            del items[:n]
+            if not items:
+                del _BY_CHAT[chat_id]
+
+        if removed_ids:
+            _remove_reminder_jobs(removed_ids)
+            _mark_dirty()
+
+
+def _bootstrap() -> None:
+    """
+    Старт за один проход по reminders.json (+ журнал добавлений): разбор файла, приведение типов и event_dt,
+    готовая строка для списка, индекс по чатам и постановка задач в планировщик.
+    На диск пишем, только если что-то действительно поменялось.
+    """
+    global _STORE
+    _STORE = load_data()
+    _BY_CHAT.clear()
+    _BY_ID.clear()
+
+    # Типы и формат приводим один раз при загрузке: chat_id/thread_id — int, event_dt — каноничный ISO в TZ.
+    # Дальше чтения доверяют этому и не делают int()/.get() на каждой записи.
+    changed = False
+    reminders: List[Dict[str, Any]] = []
 
-        if dt < cutoff:
-            removed_ids.append(r.get("id", ""))
-        else:
-            r["event_dt"] = dt_to_iso(dt)
-            keep.append(r)
+    # добавления, которые ещё не попали в reminders.json; после старта сольём всё в один файл
+    journal = _load_journal()
+    if journal:
+        known = {r.get("id") for r in _STORE["reminders"]}
+        _STORE["reminders"].extend(r for r in journal if r.get("id") not in known)
+        changed = True
 
-    if removed_ids:
-        for rid in removed_ids:
-            if not rid:
+    # пока добавляем задачи пачкой, планировщик не просыпается на каждую из них
+    scheduler.pause()
+    try:
+        for r in _STORE["reminders"]:
+            dt = dt_from_iso(r.get("event_dt", ""))
+            try:
+                chat_id = int(r.get("chat_id"))
+            except (TypeError, ValueError):
+                chat_id = None
+            if not dt or chat_id is None:
+                # битую запись cleanup_expired всё равно удалил бы — отбрасываем сразу
+                changed = True
                 continue
-            for kind in ("24h", "1h"):
-                try:
-                    scheduler.remove_job(f"{rid}_{kind}")
-                except Exception:
-                    pass
 
-        data["reminders"] = keep
-        save_data(data)
+            thread_id = r.get("thread_id")
+            try:
+                thread_id = int(thread_id) if thread_id is not None else None
+            except (TypeError, ValueError):
+                thread_id = None
 
+            new_iso = dt_to_iso(dt)
+            if r["event_dt"] != new_iso or r["chat_id"] != chat_id or r.get("thread_id") != thread_id:
+                r["event_dt"] = new_iso
+                r["chat_id"] = chat_id
+                r["thread_id"] = thread_id
+                changed = True
+            _prepare_reminder(r, dt)
 
-reschedule_all_from_store()
+            reminders.append(r)
+            _BY_ID[r["id"]] = r
+            _BY_CHAT[chat_id].append(r)
+            schedule_reminder_jobs(r, event_dt=dt)
+    finally:
+        scheduler.resume()
+
+    for items in _BY_CHAT.values():
+        items.sort(key=_event_sort_key)
+
+    _STORE["reminders"] = reminders
+    if changed:
+        _mark_dirty()
+
+
+with store_txn():
+    _bootstrap()
+    cleanup_expired()
+
+# при штатном завершении (в т.ч. по SIGTERM, см. __main__) дописываем то, что ждёт отложенной записи
+atexit.register(_flush_if_dirty)
+
+# клавиатуру дат собираем заранее и пересобираем в полночь, а не в момент нажатия «Добавить»
+_refresh_date_picker()
 scheduler.add_job(
-    cleanup_expired,
-    trigger="interval",
-    minutes=CLEANUP_INTERVAL_MINUTES,
-    id="cleanup_expired",
+    _refresh_date_picker,
+    trigger="cron",
+    hour=0,
+    minute=0,
+    id="refresh_date_picker",
     replace_existing=True
 )
 
@@ -585,9 +958,35 @@ def _norm(s: str) -> str:
 
 StorageRow = Dict[str, Any]
 
-STORAGE_DB: List[StorageRow] = []
+
+@dataclass(frozen=True, slots=True)
+class StorageIndex:
+    """
+    Загруженная база сроков целиком: строки, их названия и триграммный индекс.
+    Собирается заново при каждой загрузке и подменяется одним присваиванием,
+    поэтому поиск, взявший снимок, не видит полузаполненную базу.
+    """
+    # строки базы в порядке файла
+    rows: List[StorageRow]
+    # параллельно rows: название в нижнем регистре под тем же индексом —
+    # поиск идёт по плоскому списку строк, не заглядывая в dict каждой записи
+    names_lc: List[str]
+    # триграмма -> номера строк, где она встречается; подстрока длиной >= 3
+    # может найтись только в строках, где есть все её триграммы
+    trigrams: Dict[str, Set[int]]
+
+
+STORAGE: StorageIndex = StorageIndex(rows=[], names_lc=[], trigrams={})
 STORAGE_READY: bool = False
 STORAGE_SOURCE_PATH: str = ""
+STORAGE_SHEETS: List[str] = []
+# сколько вариантов показываем кнопками; больше в state не держим
+STORAGE_PICK_LIMIT = 8
+
+# База грузится лениво — при первом заходе в поиск, а не при старте бота.
+# (путь, mtime) последней загрузки: пока файл не менялся, повторно его не разбираем.
+_STORAGE_LOADED_KEY: Optional[Tuple[str, float]] = None
+_STORAGE_LOAD_LOCK = threading.Lock()
 
 # Канон (человеческие подписи для вывода)
 H_NAME = "Наименование"
@@ -635,15 +1034,16 @@ def _canonical_header(raw: str) -> Optional[str]:
     return None
 
 
-def _guess_header_row(ws, max_rows: int = 10, max_cols: int = 30) -> int:
+def _guess_header_row(top_rows: List[tuple]) -> int:
+    # top_rows — первые строки листа (кортежи значений), номер строки в листе = индекс + 1
     best_row = 1
     best_score = -1
 
-    for r in range(1, max_rows + 1):
+    for r, values in enumerate(top_rows, 1):
         seen = set()
         score = 0
-        for c in range(1, max_cols + 1):
-            h_raw = _cell_str(ws.cell(r, c).value)
+        for v in values:
+            h_raw = _cell_str(v)
             canon = _canonical_header(h_raw)
             if not canon or canon in seen:
                 continue
@@ -671,70 +1071,135 @@ def _guess_header_row(ws, max_rows: int = 10, max_cols: int = 30) -> int:
     return best_row if best_score >= 5 else 1
 
 
-def load_storage_db() -> Tuple[int, List[str]]:
-    global STORAGE_DB, STORAGE_READY, STORAGE_SOURCE_PATH
+def load_storage_db(path: Optional[str] = None) -> Tuple[int, List[str]]:
+    global STORAGE, STORAGE_READY, STORAGE_SOURCE_PATH, STORAGE_SHEETS
 
-    path = find_storage_file()
-    STORAGE_DB = []
-    STORAGE_READY = False
-    STORAGE_SOURCE_PATH = path or ""
+    if path is None:
+        path = find_storage_file()
 
     if not path:
+        STORAGE = StorageIndex(rows=[], names_lc=[], trigrams={})
+        STORAGE_READY = False
+        STORAGE_SOURCE_PATH = ""
+        STORAGE_SHEETS = []
         return 0, []
 
-    wb = load_workbook(path, data_only=True)
-    sheet_names = wb.sheetnames
+    # собираем в локальные списки: текущая база остаётся рабочей, пока новая не готова
+    rows: List[StorageRow] = []
+    names_lc: List[str] = []
 
-    for sheet_name in sheet_names:
-        ws = wb[sheet_name]
-        header_row = _guess_header_row(ws)
+    # read_only: лист читается потоком, без модели всех ячеек в памяти;
+    # values_only: строки приходят кортежами значений, без объектов Cell
+    # keep_links=False: внешние ссылки книги нам не нужны, не тратим время на их разбор
+    wb = load_workbook(path, data_only=True, read_only=True, keep_links=False)
+    sheet_names = wb.sheetnames
 
-        col_by_header: Dict[str, int] = {}
-        for col in range(1, 31):
-            h_raw = _cell_str(ws.cell(row=header_row, column=col).value)
-            canon = _canonical_header(h_raw)
-            if canon and canon not in col_by_header:
-                col_by_header[canon] = col
-
-        name_col = col_by_header.get(H_NAME, 1)
-        sheet_has_pack = H_PACK in col_by_header
-
-        cols = {
-            H_OUT: col_by_header.get(H_OUT),
-            H_SHELF: col_by_header.get(H_SHELF),
-            H_TEMP: col_by_header.get(H_TEMP),
-            H_MARK: col_by_header.get(H_MARK),
-            H_LAYOUT: col_by_header.get(H_LAYOUT),
-            H_PACK: col_by_header.get(H_PACK),  # может быть None
-        }
-
-        for row in range(header_row + 1, ws.max_row + 1):
-            name = _cell_str(ws.cell(row=row, column=name_col).value)
-            if not name:
+    # read_only держит zip-файл открытым до close() — закрываем и тогда, когда лист не разобрался
+    try:
+        for sheet_name in sheet_names:
+            ws = wb[sheet_name]
+            top_rows = list(ws.iter_rows(min_row=1, max_row=10, max_col=30, values_only=True))
+            header_row = _guess_header_row(top_rows)
+
+            col_by_header: Dict[str, int] = {}
+            header_values = top_rows[header_row - 1] if top_rows else ()
+            for col, v in enumerate(header_values, 1):
+                canon = _canonical_header(_cell_str(v))
+                if canon and canon not in col_by_header:
+                    col_by_header[canon] = col
+
+            name_col = col_by_header.get(H_NAME, 1)
+            sheet_has_pack = H_PACK in col_by_header
+
+            # индексы полей в кортеже строки считаем один раз на лист; -1 — колонки нет (например, упаковки)
+            field_idx = tuple(
+                (h, col_by_header.get(h, 0) - 1)
+                for h in (H_OUT, H_SHELF, H_TEMP, H_MARK, H_LAYOUT, H_PACK)
+            )
+            # ни одной колонки со сроками — все строки листа всё равно отсеются как пустые, не читаем его
+            if all(i < 0 for _, i in field_idx):
                 continue
 
-            fields: Dict[str, str] = {}
-            any_field = False
+            for values in ws.iter_rows(min_row=header_row + 1, values_only=True):
+                # в read_only строки бывают короче шапки — недостающие ячейки считаем пустыми
+                n = len(values)
+                name = _cell_str(values[name_col - 1]) if name_col <= n else ""
+                if not name:
+                    continue
+
+                fields: Dict[str, str] = {}
+                any_field = False
+
+                for h, i in field_idx:
+                    v = _cell_str(values[i]) if 0 <= i < n else ""
+                    fields[h] = v
+                    if v:
+                        any_field = True
+
+                if not any_field:
+                    continue
+
+                rows.append({
+                    "category": sheet_name,
+                    "name": name,
+                    "fields": fields,
+                    "sheet_has_pack": sheet_has_pack,
+                })
+                names_lc.append(name.lower())
+    finally:
+        wb.close()
+
+    STORAGE = StorageIndex(rows=rows, names_lc=names_lc, trigrams=_build_storage_index(names_lc))
+    STORAGE_READY = len(rows) > 0
+    STORAGE_SOURCE_PATH = path
+    STORAGE_SHEETS = sheet_names
+    return len(rows), sheet_names
+
+
+def ensure_storage_loaded(force: bool = False) -> Tuple[int, List[str]]:
+    """
+    Загружает базу сроков, если она ещё не загружена или xlsx изменился с прошлой загрузки.
+    force=True — разобрать файл заново в любом случае (явный /storage_reload).
+    """
+    global _STORAGE_LOADED_KEY
+    with _STORAGE_LOAD_LOCK:
+        path = find_storage_file()
+        try:
+            key = (path, os.stat(path).st_mtime) if path else None
+        except OSError:
+            key = None
+        if not force and key is not None and key == _STORAGE_LOADED_KEY:
+            return len(STORAGE.rows), STORAGE_SHEETS
 
-            for h, c in cols.items():
-                v = _cell_str(ws.cell(row=row, column=c).value) if c else ""
-                fields[h] = v
-                if v:
-                    any_field = True
+        result = load_storage_db(path)
+        _STORAGE_LOADED_KEY = key
+        return result
 
-            if not any_field:
-                continue
 
-            STORAGE_DB.append({
-                "category": sheet_name,
-                "name": name,
-                "name_lc": name.lower(),
-                "fields": fields,
-                "sheet_has_pack": sheet_has_pack,
-            })
+def _trigrams(s: str) -> Set[str]:
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
 
-    STORAGE_READY = len(STORAGE_DB) > 0
-    return len(STORAGE_DB), sheet_names
+def _build_storage_index(names_lc: List[str]) -> Dict[str, Set[int]]:
+    index: Dict[str, Set[int]] = defaultdict(set)
+    for i, name_lc in enumerate(names_lc):
+        for t in _trigrams(name_lc):
+            index[t].add(i)
+    return dict(index)
+
+
+def _storage_candidates(db: StorageIndex, terms: List[str]) -> List[int]:
+    """
+    Номера строк db, которые могут содержать все terms как подстроки (в порядке базы).
+    Короткие (< 3 символов) термы индекс не сужают — их проверяет вызывающий код.
+    """
+    postings = [db.trigrams.get(t) for term in terms if len(term) >= 3 for t in _trigrams(term)]
+    if not postings:
+        return list(range(len(db.names_lc)))
+    if any(p is None for p in postings):
+        return []
+    postings.sort(key=len)
+    return sorted(set(postings[0]).intersection(*postings[1:]))
 
 
 def storage_search(query: str, limit: int = 12) -> List[StorageRow]:
@@ -742,14 +1207,18 @@ def storage_search(query: str, limit: int = 12) -> List[StorageRow]:
     if not q:
         return []
 
-    hits = [row for row in STORAGE_DB if q in row["name_lc"]]
+    # один снимок на весь поиск: перезагрузка базы в другом потоке его не меняет
+    db = STORAGE
+    names = db.names_lc
+    # индекс только сужает круг строк, совпадение всё равно проверяем подстрокой
+    hits = [i for i in _storage_candidates(db, [q]) if q in names[i]]
 
     if not hits:
         parts = [p for p in q.split() if p]
         if parts:
-            hits = [row for row in STORAGE_DB if all(p in row["name_lc"] for p in parts)]
+            hits = [i for i in _storage_candidates(db, parts) if all(p in names[i] for p in parts)]
 
-    return hits[:limit]
+    return [db.rows[i] for i in hits[:limit]]
 
 
 def format_storage_row(row: StorageRow) -> str:
@@ -781,7 +1250,7 @@ def format_storage_row(row: StorageRow) -> str:
 
 
 # ====== КЛАВЫ ДЛЯ СРОКОВ ХРАНЕНИЯ (без Exit и без Reload) ======
-def kb_storage_start() -> InlineKeyboardMarkup:
+def _build_storage_start() -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup()
     kb.row(InlineKeyboardButton("🔎 Новый поиск", callback_data="storage_newsearch"))
     kb.row(InlineKeyboardButton("⬅️ В меню", callback_data="nav_main"))
@@ -790,7 +1259,7 @@ def kb_storage_start() -> InlineKeyboardMarkup:
 
 def kb_storage_pick_list(results: List[StorageRow]) -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup()
-    for i, row in enumerate(results[:8]):
+    for i, row in enumerate(results[:STORAGE_PICK_LIMIT]):
         title = row.get("name", "")
         if len(title) > 40:
             title = title[:40] + "…"
@@ -800,24 +1269,57 @@ def kb_storage_pick_list(results: List[StorageRow]) -> InlineKeyboardMarkup:
     return kb
 
 
-def kb_storage_after_result() -> InlineKeyboardMarkup:
+def _build_storage_after_result() -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup()
     kb.row(InlineKeyboardButton("🔎 Новый поиск", callback_data="storage_newsearch"))
     kb.row(InlineKeyboardButton("⬅️ В меню", callback_data="nav_main"))
     return kb
 
 
+KB_STORAGE_START = _build_storage_start()
+KB_STORAGE_AFTER_RESULT = _build_storage_after_result()
+
+
 # ================== STATE HELPERS ==================
+@dataclass(slots=True)
+class UserState:
+    """
+    Незавершённый сценарий пользователя: добавление напоминания (step) или поиск сроков (mode).
+    """
+    chat_id: int
+    thread_id: Optional[int] = None
+    mode: str = ""
+    step: str = ""
+    title: str = ""
+    date: str = ""
+    storage_results: List[StorageRow] = field(default_factory=list)
+
+
+def get_user_state(user_id: int) -> Optional[UserState]:
+    with _STATES_LOCK:
+        return states.get(user_id)
+
+
+def set_user_state(user_id: int, st: UserState) -> None:
+    with _STATES_LOCK:
+        states[user_id] = st
+
+
+def has_user_state(user_id: int) -> bool:
+    with _STATES_LOCK:
+        return user_id in states
+
+
 def clear_user_state(user_id: int) -> None:
-    states.pop(user_id, None)
+    with _STATES_LOCK:
+        states.pop(user_id, None)
 
 
 def clear_storage_mode(user_id: int) -> None:
-    st = states.get(user_id)
-    if not st:
-        return
-    if st.get("mode") == "storage_search":
-        clear_user_state(user_id)
+    with _STATES_LOCK:
+        st = states.get(user_id)
+        if st and st.mode == "storage_search":
+            states.pop(user_id, None)
 
 
 # ================== УТИЛИТА: УБРАТЬ СТАРУЮ REPLY-КЛАВУ ==================
@@ -858,7 +1360,8 @@ def admin_storage_reload(message):
     # разрешаем админу даже если тема не закреплена, но работаем в текущей теме
     if not in_allowed_topic_for_message(message):
         return
-    count, sheets = load_storage_db()
+    # явная команда админа — перечитываем xlsx, даже если mtime не менялся
+    count, sheets = ensure_storage_loaded(force=True)
     tid = get_thread_id_from_message(message)
     if count == 0:
         send_locked(
@@ -894,10 +1397,15 @@ def admin_topic_clear(message):
 
 
 # ================== ПОДХВАТ СТАРЫХ КНОПОК (если их нажмут) ==================
-@bot.message_handler(func=lambda m: (m.text or "").strip() in {
+# Тексты старой reply-клавиатуры. Множество собрано один раз: предикат ниже выполняется
+# на каждое текстовое сообщение, и литерал в лямбде пересобирался бы при каждом вызове.
+LEGACY_BUTTONS = frozenset({
     "📌 Напоминания", "📚 Полезная информация", "ℹ️ О боте",
     "➕ Добавить напоминание", "📋 Все напоминания", "⬅️ Назад"
 })
+
+
+@bot.message_handler(func=lambda m: (m.text or "").strip() in LEGACY_BUTTONS)
 def legacy_buttons_handler(message):
     if not in_allowed_topic_for_message(message):
         return
@@ -908,374 +1416,442 @@ def legacy_buttons_handler(message):
 
 
 # ================== NAV + ADMIN CALLBACKS ==================
-@bot.callback_query_handler(func=lambda call: call.data.startswith(("nav_", "admin_")))
-def nav_callbacks(call):
+# Каждый обработчик получает call и часть callback_data после "|" (или "").
+# Общий роутер внизу раздела отвечает на callback и проверяет тему до вызова.
+def _cb_admin_pin_topic(call, arg: str) -> None:
     chat_id = call.message.chat.id
-    user_id = call.from_user.id
-    data = call.data
+    if not is_admin_user(call.from_user):
+        return
+    if not chat_is_group(call.message.chat):
+        send_locked(chat_id, "Эта кнопка нужна только в группах с темами.", reply_markup=kb_main_inline(call.from_user))
+        return
+
+    tid = get_thread_id_from_call(call)
+    if tid is None:
+        send_locked(
+            chat_id,
+            "⚠️ Я не вижу ID темы.\n"
+            "Открой <b>нужную тему</b> (Forum Topic) и нажми «📌 Закрепить эту тему» там.",
+            reply_markup=kb_main_inline(call.from_user)
+        )
+        return
 
+    set_allowed_thread_id(chat_id, tid)
+    clear_user_state(call.from_user.id)
+    send_locked(
+        chat_id,
+        f"✅ Готово! Закрепил эту тему.\n\n"
+        f"Теперь я буду отвечать <b>только здесь</b> и игнорировать другие темы.\n"
+        f"<i>thread_id={tid}</i>",
+        reply_markup=kb_main_inline(call.from_user),
+        fallback_thread_id=tid
+    )
+
+
+def _cb_admin_stop_bot(call, arg: str) -> None:
+    if not is_admin_user(call.from_user):
+        return
+    clear_user_state(call.from_user.id)
+    send_locked(call.message.chat.id, "🛑 Останавливаю бота…", reply_markup=None, fallback_thread_id=get_thread_id_from_call(call))
     try:
-        bot.answer_callback_query(call.id)
+        scheduler.shutdown(wait=False)
     except Exception:
         pass
+    # отложенная запись не успеет выполниться — сбрасываем хранилище сейчас
+    _flush_if_dirty()
+    # Жестко завершаем процесс — на хостинге он обычно перезапустится супервизором, если настроено.
+    os._exit(0)
 
-    # topic-lock filter
-    if not in_allowed_topic_for_call(call):
+
+def _cb_nav_main(call, arg: str) -> None:
+    chat_id = call.message.chat.id
+    clear_user_state(call.from_user.id)
+    try:
+        bot.edit_message_text("Главное меню 👇", chat_id, call.message.message_id, reply_markup=kb_main_inline(call.from_user))
+    except Exception:
+        send_locked(chat_id, "Главное меню 👇", reply_markup=kb_main_inline(call.from_user), fallback_thread_id=get_thread_id_from_call(call))
+
+
+def _cb_nav_reminders(call, arg: str) -> None:
+    chat_id = call.message.chat.id
+    clear_user_state(call.from_user.id)
+    try:
+        bot.edit_message_text("📌 <b>Напоминания</b> — выбери действие:", chat_id, call.message.message_id,
+                              reply_markup=KB_REMINDERS)
+    except Exception:
+        send_locked(chat_id, "📌 <b>Напоминания</b> — выбери действие:", reply_markup=KB_REMINDERS,
+                    fallback_thread_id=get_thread_id_from_call(call))
+
+
+def _cb_nav_useful(call, arg: str) -> None:
+    chat_id = call.message.chat.id
+    clear_user_state(call.from_user.id)
+    try:
+        bot.edit_message_text("📚 <b>Полезная информация</b> — выбери пункт:", chat_id, call.message.message_id,
+                              reply_markup=KB_USEFUL)
+    except Exception:
+        send_locked(chat_id, "📚 <b>Полезная информация</b> — выбери пункт:", reply_markup=KB_USEFUL,
+                    fallback_thread_id=get_thread_id_from_call(call))
+
+
+def _cb_nav_storage(call, arg: str) -> None:
+    chat_id = call.message.chat.id
+    # если тема закреплена — вход разрешен только из неё (фильтр в роутере уже отработал)
+    # если не закреплена — разрешаем вход только админу, и только из темы (tid != None)
+    if chat_is_group(call.message.chat) and get_allowed_thread_id(chat_id) is None and not is_admin_user(call.from_user):
         return
 
-    if data == "admin_pin_topic":
-        if not is_admin_user(call.from_user):
-            return
-        if not chat_is_group(call.message.chat):
-            send_locked(chat_id, "Эта кнопка нужна только в группах с темами.", reply_markup=kb_main_inline(call.from_user))
-            return
+    tid = get_thread_id_from_call(call)
 
-        tid = get_thread_id_from_call(call)
+    if chat_is_group(call.message.chat) and get_allowed_thread_id(chat_id) is None:
+        # админ ещё не закрепил тему
         if tid is None:
-            send_locked(
-                chat_id,
-                "⚠️ Я не вижу ID темы.\n"
-                "Открой <b>нужную тему</b> (Forum Topic) и нажми «📌 Закрепить эту тему» там.",
-                reply_markup=kb_main_inline(call.from_user)
-            )
+            send_locked(chat_id, "Открой тему и нажми «📌 Закрепить эту тему» — потом заходи в поиск.",
+                        reply_markup=kb_main_inline(call.from_user))
             return
 
-        set_allowed_thread_id(chat_id, tid)
-        clear_user_state(user_id)
+    ensure_storage_loaded()
+    if not STORAGE_READY:
         send_locked(
             chat_id,
-            f"✅ Готово! Закрепил эту тему.\n\n"
-            f"Теперь я буду отвечать <b>только здесь</b> и игнорировать другие темы.\n"
-            f"<i>thread_id={tid}</i>",
-            reply_markup=kb_main_inline(call.from_user),
+            "🧊 <b>Сроки хранения</b>\n\n"
+            "База не загружена или пустая.\n"
+            "Проверь файл рядом с bot.py или попроси админа выполнить /storage_reload",
+            reply_markup=KB_STORAGE_START,
             fallback_thread_id=tid
         )
         return
 
-    if data == "admin_stop_bot":
-        if not is_admin_user(call.from_user):
-            return
-        clear_user_state(user_id)
-        send_locked(chat_id, "🛑 Останавливаю бота…", reply_markup=None, fallback_thread_id=get_thread_id_from_call(call))
-        try:
-            scheduler.shutdown(wait=False)
-        except Exception:
-            pass
-        # Жестко завершаем процесс — на хостинге он обычно перезапустится супервизором, если настроено.
-        os._exit(0)
+    set_user_state(call.from_user.id, UserState(chat_id=chat_id, thread_id=tid, mode="storage_search"))
+    send_locked(
+        chat_id,
+        "🧊 <b>Сроки хранения — поиск</b>\n\n"
+        "Введи название продукта (можно часть слова).\n"
+        "Пример: <i>омлет</i>, <i>песто</i>, <i>суп</i>",
+        reply_markup=KB_STORAGE_START,
+        fallback_thread_id=tid
+    )
 
-    if data == "nav_main":
-        clear_user_state(user_id)
-        try:
-            bot.edit_message_text("Главное меню 👇", chat_id, call.message.message_id, reply_markup=kb_main_inline(call.from_user))
-        except Exception:
-            send_locked(chat_id, "Главное меню 👇", reply_markup=kb_main_inline(call.from_user), fallback_thread_id=get_thread_id_from_call(call))
-        return
 
-    if data == "nav_reminders":
-        clear_user_state(user_id)
-        try:
-            bot.edit_message_text("📌 <b>Напоминания</b> — выбери действие:", chat_id, call.message.message_id,
-                                  reply_markup=kb_reminders_inline(call.from_user))
-        except Exception:
-            send_locked(chat_id, "📌 <b>Напоминания</b> — выбери действие:", reply_markup=kb_reminders_inline(call.from_user),
-                        fallback_thread_id=get_thread_id_from_call(call))
-        return
+# Неизменная часть «О боте» собирается один раз; на каждый показ подставляем только состояние базы и темы.
+ABOUT_TEXT_HEAD = (
+    "ℹ️ <b>О боте</b>\n\n"
+    "• Напоминания: добавление и список\n"
+    "• Полезная информация: ссылки/материалы\n"
+    "• Сроки хранения: поиск по Excel базе\n"
+    "• Режим темы: бот живёт только в одной теме (после закрепления)\n\n"
+    f"🕒 Таймзона: <b>{TZ_NAME}</b>\n"
+    f"🧹 Автоудаление напоминаний: <b>{AUTO_DELETE_AFTER_HOURS} ч</b> после события\n"
+)
+ABOUT_TEXT_TAIL = f"🔖 Версия: <b>{BOT_VERSION}</b>"
 
-    if data == "nav_useful":
-        clear_user_state(user_id)
-        try:
-            bot.edit_message_text("📚 <b>Полезная информация</b> — выбери пункт:", chat_id, call.message.message_id,
-                                  reply_markup=kb_useful_inline())
-        except Exception:
-            send_locked(chat_id, "📚 <b>Полезная информация</b> — выбери пункт:", reply_markup=kb_useful_inline(),
-                        fallback_thread_id=get_thread_id_from_call(call))
-        return
 
-    if data == "nav_storage":
-        # если тема закреплена — вход разрешен только из неё (фильтр выше уже отработал)
-        # если не закреплена — разрешаем вход только админу, и только из темы (tid != None)
-        if chat_is_group(call.message.chat) and get_allowed_thread_id(chat_id) is None and not is_admin_user(call.from_user):
-            return
+def _cb_nav_about(call, arg: str) -> None:
+    chat_id = call.message.chat.id
+    clear_user_state(call.from_user.id)
+    allowed = get_allowed_thread_id(chat_id)
+    # база грузится лениво: файл есть, но поиском ещё не пользовались — это не «не загружена»
+    if STORAGE_READY:
+        storage_status = "загружена"
+    elif find_storage_file():
+        storage_status = "загрузится при первом поиске"
+    else:
+        storage_status = "не загружена"
+    text = (
+        f"{ABOUT_TEXT_HEAD}"
+        f"🧊 База сроков хранения: <b>{storage_status}</b>\n"
+        f"📌 Закреплённая тема: <b>{allowed if allowed is not None else 'не задана'}</b>\n"
+        f"{ABOUT_TEXT_TAIL}"
+    )
+    try:
+        bot.edit_message_text(text, chat_id, call.message.message_id, reply_markup=kb_main_inline(call.from_user))
+    except Exception:
+        send_locked(chat_id, text, reply_markup=kb_main_inline(call.from_user), fallback_thread_id=get_thread_id_from_call(call))
 
-        tid = get_thread_id_from_call(call)
 
-        if chat_is_group(call.message.chat) and get_allowed_thread_id(chat_id) is None:
-            # админ ещё не закрепил тему
-            if tid is None:
-                send_locked(chat_id, "Открой тему и нажми «📌 Закрепить эту тему» — потом заходи в поиск.",
-                            reply_markup=kb_main_inline(call.from_user))
-                return
+# ================== CALLBACKS (полезная информация) ==================
+def _cb_ui_groups(call, arg: str) -> None:
+    send_locked(call.message.chat.id, fallback_thread_id=get_thread_id_from_call(call), **GROUPS_PAYLOAD)
 
-        if not STORAGE_READY:
-            send_locked(
-                chat_id,
-                "🧊 <b>Сроки хранения</b>\n\n"
-                "База не загружена или пустая.\n"
-                "Проверь файл рядом с bot.py или попроси админа выполнить /storage_reload",
-                reply_markup=kb_storage_start(),
-                fallback_thread_id=tid
-            )
-            return
 
-        states[user_id] = {"mode": "storage_search", "chat_id": chat_id, "thread_id": tid}
-        send_locked(
+def _cb_ui_protocol(call, arg: str) -> None:
+    chat_id = call.message.chat.id
+    try:
+        bot.edit_message_text(
+            "📝 <b>Протокол собрания</b>\nВыбери раздел 👇",
             chat_id,
-            "🧊 <b>Сроки хранения — поиск</b>\n\n"
-            "Введи название продукта (можно часть слова).\n"
-            "Пример: <i>омлет</i>, <i>песто</i>, <i>суп</i>",
-            reply_markup=kb_storage_start(),
-            fallback_thread_id=tid
+            call.message.message_id,
+            reply_markup=KB_PROTOCOL
         )
-        return
+    except Exception:
+        send_locked(chat_id, "📝 <b>Протокол собрания</b>\nВыбери раздел 👇", reply_markup=KB_PROTOCOL,
+                    fallback_thread_id=get_thread_id_from_call(call))
 
-    if data == "nav_about":
-        clear_user_state(user_id)
-        allowed = get_allowed_thread_id(chat_id)
-        text = (
-            "ℹ️ <b>О боте</b>\n\n"
-            "• Напоминания: добавление и список\n"
-            "• Полезная информация: ссылки/материалы\n"
-            "• Сроки хранения: поиск по Excel базе\n"
-            "• Режим темы: бот живёт только в одной теме (после закрепления)\n\n"
-            f"🕒 Таймзона: <b>{TZ_NAME}</b>\n"
-            f"🧹 Автоудаление напоминаний: <b>{AUTO_DELETE_AFTER_HOURS} ч</b> после события\n"
-            f"🧊 База сроков хранения: <b>{'загружена' if STORAGE_READY else 'не загружена'}</b>\n"
-            f"📌 Закреплённая тема: <b>{allowed if allowed is not None else 'не задана'}</b>\n"
-            f"🔖 Версия: <b>{BOT_VERSION}</b>"
-        )
-        try:
-            bot.edit_message_text(text, chat_id, call.message.message_id, reply_markup=kb_main_inline(call.from_user))
-        except Exception:
-            send_locked(chat_id, text, reply_markup=kb_main_inline(call.from_user), fallback_thread_id=get_thread_id_from_call(call))
+
+# ================== REMINDERS MENU CALLBACKS ==================
+def _cb_rem_add(call, arg: str) -> None:
+    user_id = call.from_user.id
+    chat_id = call.message.chat.id
+    clear_user_state(user_id)
+    set_user_state(user_id, UserState(chat_id=chat_id, thread_id=get_thread_id_from_call(call), step="title"))
+    send_locked(chat_id, "Ок! Введи <b>название</b> напоминания:", reply_markup=KB_CANCEL,
+                fallback_thread_id=get_thread_id_from_call(call))
+
+
+REM_LIST_HEAD = "📋 <b>Напоминания в этом чате</b>:\n"
+REM_LIST_TAIL = f"\n\n🧹 Автоудаление: через {AUTO_DELETE_AFTER_HOURS} ч после события."
+
+
+def _cb_rem_list(call, arg: str) -> None:
+    chat_id = call.message.chat.id
+    items = get_chat_reminders(chat_id)
+    if not items:
+        send_locked(chat_id, "Пока нет напоминаний в этом чате.", reply_markup=KB_REMINDERS,
+                    fallback_thread_id=get_thread_id_from_call(call))
         return
 
+    body = "\n".join([f"{i}. {r['_render']}" for i, r in enumerate(items, 1)])
+    send_locked(
+        chat_id,
+        f"{REM_LIST_HEAD}{body}{REM_LIST_TAIL}",
+        reply_markup=KB_REMINDERS,
+        fallback_thread_id=get_thread_id_from_call(call)
+    )
 
-# ================== CALLBACKS (полезная информация) ==================
-@bot.callback_query_handler(func=lambda call: call.data.startswith("ui_"))
-def callbacks_useful(call):
-    # topic-lock filter
-    if not in_allowed_topic_for_call(call):
+
+# ================== CALLBACKS (дата/время/отмена) ==================
+def _wizard_state_for_call(call) -> Optional[UserState]:
+    st = get_user_state(call.from_user.id)
+    if not st or st.chat_id != call.message.chat.id:
+        return None
+    return st
+
+
+def _cb_cancel(call, arg: str) -> None:
+    clear_user_state(call.from_user.id)
+    send_locked(call.message.chat.id, "Ок, отменил. Возвращаюсь в меню:", reply_markup=KB_REMINDERS,
+                fallback_thread_id=get_thread_id_from_call(call))
+
+
+def _cb_date(call, arg: str) -> None:
+    st = _wizard_state_for_call(call)
+    if not st:
         return
+    chat_id = call.message.chat.id
+    st.date = arg
+    st.step = "time_pick"
+    try:
+        bot.edit_message_text(
+            "Дата выбрана ✅\nТеперь выбери <b>время</b>:",
+            chat_id,
+            call.message.message_id,
+            reply_markup=TIME_PICKER
+        )
+    except Exception:
+        send_locked(chat_id, "Дата выбрана ✅\nТеперь выбери <b>время</b>:", reply_markup=TIME_PICKER,
+                    fallback_thread_id=get_thread_id_from_call(call))
 
+
+def _cb_date_manual(call, arg: str) -> None:
+    st = _wizard_state_for_call(call)
+    if not st:
+        return
     chat_id = call.message.chat.id
-    data = call.data
+    st.step = "date_manual"
+    try:
+        bot.edit_message_text(
+            "Введи дату вручную: <b>31.12.2026</b> или <b>2026-12-31</b>",
+            chat_id,
+            call.message.message_id
+        )
+    except Exception:
+        send_locked(chat_id, "Введи дату вручную: <b>31.12.2026</b> или <b>2026-12-31</b>",
+                    fallback_thread_id=get_thread_id_from_call(call))
+
 
+def _cb_time(call, arg: str) -> None:
+    if not _wizard_state_for_call(call):
+        return
+    chat_id = call.message.chat.id
     try:
-        bot.answer_callback_query(call.id)
+        bot.edit_message_reply_markup(chat_id, call.message.message_id, reply_markup=None)
     except Exception:
         pass
+    finalize_reminder(call.from_user.id, chat_id, arg)
 
-    if data == "ui_groups":
-        send_locked(chat_id, GROUPS_TEXT, disable_web_page_preview=True, reply_markup=kb_useful_inline(),
-                    fallback_thread_id=get_thread_id_from_call(call))
-        return
 
-    if data == "ui_protocol":
-        try:
-            bot.edit_message_text(
-                "📝 <b>Протокол собрания</b>\nВыбери раздел 👇",
-                chat_id,
-                call.message.message_id,
-                reply_markup=kb_protocol_inline()
-            )
-        except Exception:
-            send_locked(chat_id, "📝 <b>Протокол собрания</b>\nВыбери раздел 👇", reply_markup=kb_protocol_inline(),
-                        fallback_thread_id=get_thread_id_from_call(call))
+def _cb_time_manual(call, arg: str) -> None:
+    st = _wizard_state_for_call(call)
+    if not st:
         return
+    chat_id = call.message.chat.id
+    st.step = "time_manual"
+    try:
+        bot.edit_message_text(
+            "Введи время вручную в формате <b>HH:MM</b> (например, <b>18:30</b>):",
+            chat_id,
+            call.message.message_id
+        )
+    except Exception:
+        send_locked(chat_id, "Введи время вручную в формате <b>HH:MM</b> (например, <b>18:30</b>):",
+                    fallback_thread_id=get_thread_id_from_call(call))
 
 
-# ================== REMINDERS MENU CALLBACKS ==================
-@bot.callback_query_handler(func=lambda call: call.data in {"rem_add", "rem_list"})
-def reminders_menu_callbacks(call):
-    if not in_allowed_topic_for_call(call):
-        return
+# ================== CALLBACKS (сроки хранения) ==================
+def _cb_storage_newsearch(call, arg: str) -> None:
+    chat_id = call.message.chat.id
+    set_user_state(call.from_user.id, UserState(chat_id=chat_id, thread_id=get_thread_id_from_call(call), mode="storage_search"))
+    send_locked(chat_id, "🔎 Введи название продукта для поиска:", reply_markup=KB_STORAGE_START,
+                fallback_thread_id=get_thread_id_from_call(call))
 
+
+def _cb_storage_pick(call, arg: str) -> None:
     chat_id = call.message.chat.id
     user_id = call.from_user.id
-    data = call.data
-
+    st = get_user_state(user_id)
+    results = st.storage_results if st else []
     try:
-        bot.answer_callback_query(call.id)
+        idx = int(arg)
     except Exception:
-        pass
+        idx = -1
 
-    if data == "rem_add":
-        clear_user_state(user_id)
-        states[user_id] = {
-            "step": "title",
-            "chat_id": chat_id,
-            "thread_id": get_thread_id_from_call(call)
-        }
-        send_locked(chat_id, "Ок! Введи <b>название</b> напоминания:", reply_markup=kb_cancel_inline(),
+    if not results or idx < 0 or idx >= len(results):
+        send_locked(chat_id, "Не нашёл выбранный результат. Сделай новый поиск.", reply_markup=KB_STORAGE_AFTER_RESULT,
                     fallback_thread_id=get_thread_id_from_call(call))
         return
 
-    if data == "rem_list":
-        items = get_chat_reminders(chat_id)
-        if not items:
-            send_locked(chat_id, "Пока нет напоминаний в этом чате.", reply_markup=kb_reminders_inline(call.from_user),
-                        fallback_thread_id=get_thread_id_from_call(call))
-            return
-
-        lines = ["📋 <b>Напоминания в этом чате</b>:"]
-        for i, r in enumerate(items, 1):
-            lines.append(f"{i}. <b>{r['title']}</b> — {format_event_dt(r['event_dt'])}")
-        lines.append(f"\n🧹 Автоудаление: через {AUTO_DELETE_AFTER_HOURS} ч после события.")
-        send_locked(chat_id, "\n".join(lines), reply_markup=kb_reminders_inline(call.from_user),
-                    fallback_thread_id=get_thread_id_from_call(call))
-        return
+    row = results[idx]
+    send_locked(chat_id, format_storage_row(row), reply_markup=KB_STORAGE_AFTER_RESULT,
+                fallback_thread_id=get_thread_id_from_call(call))
+    clear_storage_mode(user_id)
+
+
+# ================== CALLBACK ROUTER ==================
+# callback_data имеет вид "<ключ>" или "<ключ>|<аргумент>" — один partition и один поиск в dict
+# вместо цепочки startswith/== по всем обработчикам.
+_CB_HANDLERS = {
+    "admin_pin_topic": _cb_admin_pin_topic,
+    "admin_stop_bot": _cb_admin_stop_bot,
+    "nav_main": _cb_nav_main,
+    "nav_reminders": _cb_nav_reminders,
+    "nav_useful": _cb_nav_useful,
+    "nav_storage": _cb_nav_storage,
+    "nav_about": _cb_nav_about,
+    "ui_groups": _cb_ui_groups,
+    "ui_protocol": _cb_ui_protocol,
+    "rem_add": _cb_rem_add,
+    "rem_list": _cb_rem_list,
+    "cancel": _cb_cancel,
+    "date": _cb_date,
+    "date_manual": _cb_date_manual,
+    "time": _cb_time,
+    "time_manual": _cb_time_manual,
+    "storage_newsearch": _cb_storage_newsearch,
+    "storage_pick": _cb_storage_pick,
+}
 
 
-# ================== CALLBACKS (дата/время/отмена) ==================
-@bot.callback_query_handler(
-    func=lambda call: (
-        call.data in {"cancel", "date_manual", "time_manual"} or
-        call.data.startswith("date|") or
-        call.data.startswith("time|")
-    )
-)
-def callbacks_reminders(call):
-    if not in_allowed_topic_for_call(call):
+@bot.callback_query_handler(func=lambda call: True)
+def callbacks_router(call):
+    key, _, arg = (call.data or "").partition("|")
+    handler = _CB_HANDLERS.get(key)
+    if handler is None:
         return
 
-    user_id = call.from_user.id
-    chat_id = call.message.chat.id
-    st = states.get(user_id)
-    data = call.data
-
     try:
         bot.answer_callback_query(call.id)
     except Exception:
         pass
 
-    if data == "cancel":
-        clear_user_state(user_id)
-        send_locked(chat_id, "Ок, отменил. Возвращаюсь в меню:", reply_markup=kb_reminders_inline(call.from_user),
-                    fallback_thread_id=get_thread_id_from_call(call))
+    # topic-lock filter
+    if not in_allowed_topic_for_call(call):
         return
 
-    if not st or int(st.get("chat_id")) != int(chat_id):
-        return
+    handler(call, arg)
 
-    if data.startswith("date|"):
-        date_iso = data.split("|", 1)[1]
-        st["date"] = date_iso
-        st["step"] = "time_pick"
-        try:
-            bot.edit_message_text(
-                "Дата выбрана ✅\nТеперь выбери <b>время</b>:",
-                chat_id,
-                call.message.message_id,
-                reply_markup=build_time_picker()
-            )
-        except Exception:
-            send_locked(chat_id, "Дата выбрана ✅\nТеперь выбери <b>время</b>:", reply_markup=build_time_picker(),
-                        fallback_thread_id=get_thread_id_from_call(call))
-        return
 
-    if data == "date_manual":
-        st["step"] = "date_manual"
-        try:
-            bot.edit_message_text(
-                "Введи дату вручную: <b>31.12.2026</b> или <b>2026-12-31</b>",
-                chat_id,
-                call.message.message_id
-            )
-        except Exception:
-            send_locked(chat_id, "Введи дату вручную: <b>31.12.2026</b> или <b>2026-12-31</b>",
-                        fallback_thread_id=get_thread_id_from_call(call))
-        return
+# ================== ТЕКСТОВЫЙ РОУТЕР (ТОЛЬКО КОГДА ЕСТЬ STATE) ==================
+class WizardActiveFilter(SimpleCustomFilter):
+    """Сообщение от пользователя, у которого идёт сценарий (добавление напоминания / поиск)."""
+    key = "wizard_active"
 
-    if data.startswith("time|"):
-        time_hhmm = data.split("|", 1)[1]
-        try:
-            bot.edit_message_reply_markup(chat_id, call.message.message_id, reply_markup=None)
-        except Exception:
-            pass
-        finalize_reminder(user_id, chat_id, time_hhmm)
-        return
+    def check(self, message) -> bool:
+        return has_user_state(message.from_user.id)
 
-    if data == "time_manual":
-        st["step"] = "time_manual"
-        try:
-            bot.edit_message_text(
-                "Введи время вручную в формате <b>HH:MM</b> (например, <b>18:30</b>):",
-                chat_id,
-                call.message.message_id
-            )
-        except Exception:
-            send_locked(chat_id, "Введи время вручную в формате <b>HH:MM</b> (например, <b>18:30</b>):",
-                        fallback_thread_id=get_thread_id_from_call(call))
-        return
 
+bot.add_custom_filter(WizardActiveFilter())
 
-# ================== CALLBACKS (сроки хранения) ==================
-@bot.callback_query_handler(func=lambda call: call.data.startswith("storage_"))
-def callbacks_storage(call):
-    if not in_allowed_topic_for_call(call):
+
+def _step_title(message, st: UserState) -> None:
+    title = (message.text or "").strip()
+    if not title:
+        send_locked(message.chat.id, "Название не может быть пустым. Введи ещё раз:", reply_markup=KB_CANCEL,
+                    fallback_thread_id=get_thread_id_from_message(message))
         return
 
-    chat_id = call.message.chat.id
-    user_id = call.from_user.id
-    data = call.data
+    st.title = title
+    st.step = "date_pick"
+    send_locked(message.chat.id, "Выбери <b>дату</b>:", reply_markup=build_date_picker(),
+                fallback_thread_id=get_thread_id_from_message(message))
 
-    try:
-        bot.answer_callback_query(call.id)
-    except Exception:
-        pass
 
-    if data == "storage_newsearch":
-        states[user_id] = {"mode": "storage_search", "chat_id": chat_id, "thread_id": get_thread_id_from_call(call)}
-        send_locked(chat_id, "🔎 Введи название продукта для поиска:", reply_markup=kb_storage_start(),
-                    fallback_thread_id=get_thread_id_from_call(call))
+def _step_date_manual(message, st: UserState) -> None:
+    raw = (message.text or "").strip()
+    d = parse_date_input(raw)
+
+    if not d:
+        send_locked(message.chat.id, "Не понял дату. Пример: <b>31.12.2026</b> или <b>2026-12-31</b>",
+                    fallback_thread_id=get_thread_id_from_message(message))
         return
 
-    if data.startswith("storage_pick|"):
-        st = states.get(user_id, {})
-        results = st.get("storage_results", [])
-        try:
-            idx = int(data.split("|", 1)[1])
-        except Exception:
-            idx = -1
+    st.date = d.isoformat()
+    st.step = "time_pick"
+    send_locked(message.chat.id, "Теперь выбери <b>время</b>:", reply_markup=TIME_PICKER,
+                fallback_thread_id=get_thread_id_from_message(message))
 
-        if not results or idx < 0 or idx >= len(results):
-            send_locked(chat_id, "Не нашёл выбранный результат. Сделай новый поиск.", reply_markup=kb_storage_after_result(),
-                        fallback_thread_id=get_thread_id_from_call(call))
-            return
 
-        row = results[idx]
-        send_locked(chat_id, format_storage_row(row), reply_markup=kb_storage_after_result(),
-                    fallback_thread_id=get_thread_id_from_call(call))
-        clear_storage_mode(user_id)
+def _step_time_manual(message, st: UserState) -> None:
+    raw = (message.text or "").strip()
+    if not validate_time_hhmm(raw):
+        send_locked(message.chat.id, "Не понял время. Пример: <b>18:30</b> (формат HH:MM)",
+                    fallback_thread_id=get_thread_id_from_message(message))
         return
 
+    finalize_reminder(message.from_user.id, message.chat.id, raw)
 
-# ================== ТЕКСТОВЫЙ РОУТЕР (ТОЛЬКО КОГДА ЕСТЬ STATE) ==================
-@bot.message_handler(func=lambda m: states.get(m.from_user.id) is not None, content_types=["text"])
+
+# шаги, на которых ждём текст; на остальных (date_pick, time_pick) текст игнорируем
+_STEP_HANDLERS = {
+    "title": _step_title,
+    "date_manual": _step_date_manual,
+    "time_manual": _step_time_manual,
+}
+
+
+@bot.message_handler(wizard_active=True, content_types=["text"])
 def text_router(message):
     if not in_allowed_topic_for_message(message):
         return
 
     user_id = message.from_user.id
-    st = states.get(user_id)
+    st = get_user_state(user_id)
     if not st:
         return
 
-    chat_id = st.get("chat_id")
-    if int(chat_id) != int(message.chat.id):
+    if st.chat_id != message.chat.id:
         return
 
     # ====== режим поиска сроков хранения ======
-    if st.get("mode") == "storage_search":
+    if st.mode == "storage_search":
         query = (message.text or "").strip()
         if not query:
-            send_locked(message.chat.id, "Введи название продукта текстом.", reply_markup=kb_storage_start(),
+            send_locked(message.chat.id, "Введи название продукта текстом.", reply_markup=KB_STORAGE_START,
                         fallback_thread_id=get_thread_id_from_message(message))
             return
 
+        ensure_storage_loaded()
         if not STORAGE_READY:
-            send_locked(message.chat.id, "База не загружена или пустая.", reply_markup=kb_storage_start(),
+            send_locked(message.chat.id, "База не загружена или пустая.", reply_markup=KB_STORAGE_START,
                         fallback_thread_id=get_thread_id_from_message(message))
             return
 
@@ -1285,15 +1861,15 @@ def text_router(message):
                 message.chat.id,
                 f"Ничего не нашёл по запросу: <b>{query}</b>\n"
                 "Попробуй другое слово или более короткий запрос.",
-                reply_markup=kb_storage_start(),
+                reply_markup=KB_STORAGE_START,
                 fallback_thread_id=get_thread_id_from_message(message)
             )
             return
 
-        st["storage_results"] = results
+        st.storage_results = results[:STORAGE_PICK_LIMIT]
 
         if len(results) == 1:
-            send_locked(message.chat.id, format_storage_row(results[0]), reply_markup=kb_storage_after_result(),
+            send_locked(message.chat.id, format_storage_row(results[0]), reply_markup=KB_STORAGE_AFTER_RESULT,
                         fallback_thread_id=get_thread_id_from_message(message))
             clear_storage_mode(user_id)
             return
@@ -1303,71 +1879,39 @@ def text_router(message):
         return
 
     # ====== сценарий напоминаний ======
-    step = st.get("step")
-
-    if step == "title":
-        title = (message.text or "").strip()
-        if not title:
-            send_locked(message.chat.id, "Название не может быть пустым. Введи ещё раз:", reply_markup=kb_cancel_inline(),
-                        fallback_thread_id=get_thread_id_from_message(message))
-            return
-
-        st["title"] = title
-        st["step"] = "date_pick"
-        send_locked(message.chat.id, "Выбери <b>дату</b>:", reply_markup=build_date_picker(),
-                    fallback_thread_id=get_thread_id_from_message(message))
-        return
-
-    if step == "date_manual":
-        raw = (message.text or "").strip()
-        date_iso = None
-        for fmt in ("%d.%m.%Y", "%Y-%m-%d"):
-            try:
-                d = datetime.strptime(raw, fmt).date()
-                date_iso = d.isoformat()
-                break
-            except ValueError:
-                pass
+    handler = _STEP_HANDLERS.get(st.step)
+    if handler is not None:
+        handler(message, st)
 
-        if not date_iso:
-            send_locked(message.chat.id, "Не понял дату. Пример: <b>31.12.2026</b> или <b>2026-12-31</b>",
-                        fallback_thread_id=get_thread_id_from_message(message))
-            return
 
-        st["date"] = date_iso
-        st["step"] = "time_pick"
-        send_locked(message.chat.id, "Теперь выбери <b>время</b>:", reply_markup=build_time_picker(),
-                    fallback_thread_id=get_thread_id_from_message(message))
-        return
-
-    if step == "time_manual":
-        raw = (message.text or "").strip()
-        if not validate_time_hhmm(raw):
-            send_locked(message.chat.id, "Не понял время. Пример: <b>18:30</b> (формат HH:MM)",
-                        fallback_thread_id=get_thread_id_from_message(message))
-            return
-
-        finalize_reminder(user_id, message.chat.id, raw)
-        return
+CONFIRM_TEXT_HEAD = "✅ Напоминание добавлено!\n"
+CONFIRM_TEXT_TAIL = (
+    "\nЯ напомню <b>за 24 часа</b> и <b>за 1 час</b> до события.\n"
+    f"🧹 Автоудаление: через <b>{AUTO_DELETE_AFTER_HOURS} ч</b> после события.\n\n"
+    "Дальше что делаем?"
+)
 
 
 def finalize_reminder(user_id: int, chat_id: int, time_hhmm: str) -> None:
-    st = states.get(user_id)
+    st = get_user_state(user_id)
     if not st:
         return
 
-    title = st["title"]
-    date_iso = st["date"]
+    title = st.title
+    date_iso = st.date
 
-    event_dt_naive = datetime.strptime(f"{date_iso} {time_hhmm}", "%Y-%m-%d %H:%M")
-    event_dt = TZ.localize(event_dt_naive)
+    # дата в state всегда ISO, время уже прошло _RE_TIME (кнопка или validate_time_hhmm) —
+    # собираем datetime напрямую, без strptime
+    d = date.fromisoformat(date_iso)
+    hh, mm = map(int, _RE_TIME.fullmatch(time_hhmm).groups())
+    event_dt = datetime(d.year, d.month, d.day, hh, mm, tzinfo=TZ)
 
     if event_dt <= now_tz():
         send_locked(chat_id, "Это время уже в прошлом. Давай выберем заново дату/время.",
-                    fallback_thread_id=st.get("thread_id"))
-        st["step"] = "date_pick"
+                    fallback_thread_id=st.thread_id)
+        st.step = "date_pick"
         send_locked(chat_id, "Выбери <b>дату</b>:", reply_markup=build_date_picker(),
-                    fallback_thread_id=st.get("thread_id"))
+                    fallback_thread_id=st.thread_id)
         return
 
     # Для групп с закреплённой темой — всегда пишем туда.
@@ -1377,41 +1921,50 @@ def finalize_reminder(user_id: int, chat_id: int, time_hhmm: str) -> None:
     if allowed is not None:
         thread_id = allowed
     else:
-        thread_id = st.get("thread_id")
+        thread_id = st.thread_id
 
     rem = {
-        "id": uuid.uuid4().hex,
-        "chat_id": int(chat_id),
-        "creator_id": int(user_id),
+        "id": secrets.token_hex(8),
+        "chat_id": chat_id,
+        "creator_id": user_id,
         "title": title,
         "event_dt": dt_to_iso(event_dt),
         "created_at": dt_to_iso(now_tz()),
-        "thread_id": int(thread_id) if thread_id is not None else None
+        "thread_id": thread_id
     }
 
-    add_reminder_to_store(rem)
-    schedule_reminder_jobs(rem)
+    with store_txn():
+        add_reminder_to_store(rem, event_dt=event_dt)
+        schedule_reminder_jobs(rem, event_dt=event_dt)
+
+    # те же поля, что уже разобраны выше, — без strftime
+    when = f"{d.day:02d}.{d.month:02d}.{d.year} {hh:02d}:{mm:02d}"
 
     send_locked(
         chat_id,
-        "✅ Напоминание добавлено!\n"
-        f"<b>{title}</b>\n"
-        f"📅 {event_dt.strftime('%d.%m.%Y %H:%M')}\n"
-        "Я напомню <b>за 24 часа</b> и <b>за 1 час</b> до события.\n"
-        f"🧹 Автоудаление: через <b>{AUTO_DELETE_AFTER_HOURS} ч</b> после события.\n\n"
-        "Дальше что делаем?",
-        reply_markup=kb_reminders_inline(),
+        f"{CONFIRM_TEXT_HEAD}<b>{html.escape(title)}</b>\n📅 {when}{CONFIRM_TEXT_TAIL}",
+        reply_markup=KB_REMINDERS,
         fallback_thread_id=thread_id
     )
 
     clear_user_state(user_id)
 
 
-# ======= загрузка базы при старте =======
-_count, _sheets = load_storage_db()
+def _on_sigterm(signum, frame) -> None:
+    # сам не пишем: обработчик может прервать поток посреди изменения стора.
+    # SystemExit раскрутит стек (локи отпустятся), а запись сделает atexit.
+    sys.exit(0)
 
 
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, _on_sigterm)
     print(f"🤖 Bot is running. TZ={TZ_NAME} | VERSION={BOT_VERSION}")
-    print(f"🧊 Storage ready: {STORAGE_READY} | file: {STORAGE_SOURCE_PATH} | rows: {len(STORAGE_DB)}")
-    bot.infinity_polling(skip_pending=True)
+    print(f"🧊 Storage file: {find_storage_file() or 'not found'} | loads on first search")
+    # long polling: Telegram держит запрос до 50 с, пока нет апдейтов (timeout HTTP-клиента — с запасом сверху);
+    # хендлеры есть только на message и callback_query — остальные типы апдейтов не запрашиваем
+    bot.infinity_polling(
+        skip_pending=True,
+        timeout=60,
+        long_polling_timeout=50,
+        allowed_updates=["message", "callback_query"],
+    )